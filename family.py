@@ -5,43 +5,85 @@
 
 import random
 import logging
-import multiprocessing
-from abc import abstractmethod
+
+import numpy as np
+from numba import get_num_threads, njit, prange
+
+# Log every move of the Python game (not the compiled kernels) at DEBUG level
+DEBUG = False
+
+# Number of chips of each value 1..10 in a full pile
+BASE_CHIPS = np.array([15] * 5 + [11] * 5, dtype=np.int32)
+TOTAL_CHIPS = int(BASE_CHIPS.sum())
+# Value of the chip counted at each index of a chips array
+CHIP_VALUES = np.arange(1, 11, dtype=np.int32)
+
+# Columns of the player state matrix used by the compiled game, after the
+# 10 chip counts
+DIAMONDS = 10
+SCORE = 11
+DRAWN = 12
+HAS_WON = 13
+# Bit c set when the chip count at column c is non-zero
+HELD = 14
+N_COLS = 15
+
+# Slot of the compiled pool holding the number of chips left, after the 10
+# chip counts
+POOL_TOTAL = 10
+
+# Strategy ids understood by Player.will_draw and will_draw_kernel
+THRESHOLD = 0
+RANDOM = 1
+CONSERVATIVE = 2
+GREEDY = 3
+# Only understood by Player.will_draw, as it asks on the command line
+INTERACTIVE = 4
 
 
 class ChipPool:
     """Pool of chips at center of table"""
 
     def __init__(self, players):
-        self.chips = {}
+        self.chips = None
+        self.total = 0
         self.players = players
         self.reset()
 
     def reset(self):
         """Reset the pile for a new game"""
-        self.chips = {i: (15 if i < 6 else 11) for i in range(1, 11)}
+        self.chips = BASE_CHIPS.copy()
+        self.total = TOTAL_CHIPS
 
     def draw(self):
         """Draw a chip and give to the player"""
-        if sum(self.chips.values()) == 0:
-            logging.debug("Pile is empty!")
-            logging.debug("Making a new centre pile")
-            self.chips = {i: (15 if i < 6 else 11) for i in range(1, 11)}
-            for player in self.players:
-                for k, v in player.chips.items():
-                    self.chips[k] -= v
-        chip = random.choices(range(1, 11), weights=self.chips.values())[0]
-        self.chips[chip] -= 1
+        if self.total == 0:
+            if DEBUG:
+                logging.debug("Pile is empty!")
+                logging.debug("Making a new centre pile")
+            held = np.sum([p.chips for p in self.players], axis=0, dtype=np.int32)
+            self.chips = BASE_CHIPS - held
+            self.total = int(self.chips.sum())
+        r = random.random() * self.total
+        cumulative = 0
+        for chip, count in enumerate(self.chips.tolist(), 1):
+            cumulative += count
+            if r < cumulative:
+                break
+        self.chips[chip - 1] -= 1
+        self.total -= 1
         return chip
 
 
 class Player:
-    """A basic player, drawing only once each time"""
+    """A player, drawing according to the strategy given by strategy_id"""
 
-    def __init__(self, name, players=None):
+    def __init__(self, name, strategy_id, params=(0, 0, 0), players=None):
         self.name = name
+        self.strategy_id = strategy_id
+        self.p0, self.p1, self.p2 = params
         self.players = players
-        self.chips = {}
+        self.chips = np.zeros(10, dtype=np.int32)
         self.diamonds = 0
         self.score = 0
         self.drawn_chips = 0
@@ -58,56 +100,96 @@ class Player:
 
     def reset_chips(self):
         """Throw away all chips"""
-        for chip in range(1, 11):
-            self.chips[chip] = 0
+        self.chips.fill(0)
 
-    @abstractmethod
     def will_draw(self):
-        """Logic for whether or not to draw more"""
-        raise NotImplementedError()
+        """
+        Logic for whether or not to draw more
+
+        See the player factories below for the parameters p0, p1 and p2 of
+        each strategy.
+        """
+        s = self.strategy_id
+        if s == THRESHOLD:
+            return self.drawn_chips < self.p0
+        if s == RANDOM:
+            return random.random() < self.p0
+        if s == CONSERVATIVE:
+            if self.drawn_chips < self.p1:
+                return True
+            return self.to_be_stolen() < self.p0
+        if s == GREEDY:
+            if self.p2 and self.drawn_chips < self.p2:
+                return True
+            stealable, stolen = self.calc_opponent_totals()
+            return stealable > self.p0 or stolen < self.p1
+        if input(f"{self.name}, will you draw a chip? [Y/n] ").lower() == "n":
+            return False
+        return True
+
+    @property
+    def params(self):
+        """Strategy parameters, packed for will_draw_kernel"""
+        return (self.p0, self.p1, self.p2)
 
     def calc_stealable(self):
         """Calculate the amount in all player hands able to steal"""
         stealable = 0
         for player in self.players:
-            if player == self:
+            if player is self:
                 continue
-            stealable += sum([k * v for k, v in player.chips.items()])
+            stealable += int(np.dot(CHIP_VALUES, player.chips))
         return stealable
 
     def to_be_stolen(self):
         """Calculate how much is about to be stolen if player decides to stop drawing"""
         stolen = 0
+        mask = self.chips > 0
         for player in self.players:
-            if player == self:
+            if player is self:
                 continue
-            stolen += sum([k * v for k, v in player.chips.items() if k in self.chips])
+            stolen += int(np.dot(CHIP_VALUES, player.chips * mask))
         return stolen
 
+    def calc_opponent_totals(self):
+        """Calculate both calc_stealable and to_be_stolen in one pass"""
+        stealable = 0
+        stolen = 0
+        mask = self.chips > 0
+        for player in self.players:
+            if player is self:
+                continue
+            values = CHIP_VALUES * player.chips
+            stealable += int(values.sum())
+            stolen += int(values[mask].sum())
+        return stealable, stolen
+
     def step1(self):
         """Step 1 in player's turn"""
         advance = 0
         if self.diamonds == 3:
-            logging.debug("%s has 3 diamonds and anvances 50", self.name)
+            if DEBUG:
+                logging.debug("%s has 3 diamonds and anvances 50", self.name)
             self.diamonds = 0
             advance += 50
-        for k, v in self.chips.items():
-            advance += k * v
+        advance += int(np.dot(CHIP_VALUES, self.chips))
         self.reset_chips()
         self.score += advance
-        if advance > 0:
-            logging.debug(
-                "%s advances %s to %s",
-                self.name,
-                advance,
-                self.score,
-            )
-        else:
-            logging.debug("%s doesn't advance", self.name)
+        if DEBUG:
+            if advance > 0:
+                logging.debug(
+                    "%s advances %s to %s",
+                    self.name,
+                    advance,
+                    self.score,
+                )
+            else:
+                logging.debug("%s doesn't advance", self.name)
         if self.score >= 100:
-            logging.debug(
-                "%s has gotten a score greater than 100 and has WON!", self.name
-            )
+            if DEBUG:
+                logging.debug(
+                    "%s has gotten a score greater than 100 and has WON!", self.name
+                )
             self.has_won = True
 
     def step2(self, pool):
@@ -116,148 +198,281 @@ class Player:
         while self.will_draw():
             chip = pool.draw()
             self.drawn_chips += 1
-            logging.debug("%s drew %d", self.name, chip)
-            if self.chips[chip] > 0:
-                logging.debug("%s already has %d!", self.name, chip)
+            if DEBUG:
+                logging.debug("%s drew %d", self.name, chip)
+            # step1 emptied the hand, so it holds at most one of each chip
+            held = chip - 1
+            if self.chips[held]:
+                if DEBUG:
+                    logging.debug("%s already has %d!", self.name, chip)
                 if self.drawn_chips <= 3:
                     self.diamonds += 1
-                    logging.debug(
-                        "%s gets a diamond (has now %d diamonds)",
-                        self.name,
-                        self.diamonds,
-                    )
+                    if DEBUG:
+                        logging.debug(
+                            "%s gets a diamond (has now %d diamonds)",
+                            self.name,
+                            self.diamonds,
+                        )
                     # f"{self.name} gets a diamond (has now {self.diamonds} diamonds)"
                 self.reset_chips()
                 return
-            self.chips[chip] += 1
+            self.chips[held] = 1
 
     def step3(self, players):
         """Step 3 in player's turn"""
-        robbing_chips = [k for k, v in self.chips.items() if v > 0]
+        mask = self.chips > 0
         for player in players:
-            if player == self:
+            if player is self:
                 continue
-            for chip in robbing_chips:
-                stolen = player.chips[chip]
-                if stolen > 0:
+            stolen = player.chips * mask
+            if DEBUG:
+                for chip in np.flatnonzero(stolen) + 1:
                     logging.debug(
                         "%s steals %d %ds from %s",
                         self.name,
-                        stolen,
+                        stolen[chip - 1],
                         chip,
                         player.name,
                     )
                     # f"{self.name} steals {stolen} {chip}s from {player.name}"
-                self.chips[chip] += stolen
-                player.chips[chip] = 0
+            self.chips += stolen
+            player.chips *= ~mask
 
 
-class InteractivePlayer(Player):
+def InteractivePlayer(name, **common):
     """Interactive CLI player"""
+    return Player(name, INTERACTIVE, **common)
 
-    def will_draw(self):
-        """Logic for whether to draw"""
-        if input(f"{self.name}, will you draw a chip? [Y/n] ").lower() == "n":
-            return False
-        return True
-
-
-class RandomPlayer(Player):
-    """AI randomly drawing"""
-
-    def __init__(self, name, r=0.5, **common):
-        self.r = r
-        super().__init__(name, **common)
-
-    def will_draw(self):
-        """Draw at random, at chance self.r"""
-        return random.random() < self.r
 
+def RandomPlayer(name, r=0.5, **common):
+    """AI randomly drawing, at chance r"""
+    return Player(name, RANDOM, (r, 0, 0), **common)
 
-class ThresholdPlayer(Player):
-    """AI based on threshold"""
 
-    def __init__(self, name, n, **common):
-        self.n = n
-        super().__init__(name, **common)
+def ThresholdPlayer(name, n, **common):
+    """
+    AI based on threshold
 
-    def will_draw(self):
-        """
-        Logic for whether to draw
+    n is the maximum number of chips the player wants to have,
+    i.e. draw if their number of chips is less than n
+    """
+    return Player(name, THRESHOLD, (n, 0, 0), **common)
 
-        self.n is the maximum number of chips the player wants to have,
-        i.e. draw if their number of chips is less than self.n
-        """
-        return self.drawn_chips < self.n
 
+def ConservativePlayer(name, satisfaction, n, **common):
+    """
+    AI only taking until satisfied (or hits drawn chips)
 
-class ConservativePlayer(Player):
-    """AI only taking until satisfied (or hits drawn chips)"""
+    Never draw more than n
+    Draw if to-be-stolen < satisfaction
+    """
+    return Player(name, CONSERVATIVE, (satisfaction, n, 0), **common)
 
-    def __init__(self, name, satisfaction, n, **common):
-        self.n = n
-        self.satisfaction = satisfaction
-        super().__init__(name, **common)
-
-    def will_draw(self):
-        """
-        Never draw more than self.n
-        Draw if to-be-stolen < self.satisfaction
-        """
-        if self.drawn_chips < self.n:
-            return True
-        return self.to_be_stolen() < self.satisfaction
 
+def GreedyPlayer(name, stealable, stolen, n=None, **common):
+    """
+    AI based on threshold and number of stealable chips
 
-class GreedyPlayer(Player):
-    """AI based on threshold and number of stealable chips"""
-
-    def __init__(self, name, stealable, stolen, n=None, **common):
-        self.n = n
-        self.stealable = stealable
-        self.stolen = stolen
-        super().__init__(name, **common)
-
-    def will_draw(self):
-        """
-        Draw a maximum of self.n chips.
-        Draw if sum of stealable chips > self.stealable.
-        If stealable chips is less than self.stealable, draw until self.stolen
-        has been stolen.
-        """
-        if self.n and self.drawn_chips < self.n:
-            return True
-        if self.calc_stealable() > self.stealable:
-            return True
-        if self.to_be_stolen() < self.stolen:
-            return True
-        return False
+    Draw a maximum of n chips.
+    Draw if sum of stealable chips > stealable.
+    If stealable chips is less than stealable, draw until stolen
+    has been stolen.
+    """
+    return Player(name, GREEDY, (stealable, stolen, n or 0), **common)
 
 
 def game(players):
-    """One game"""
+    """One game, returning the index of the winner in players"""
     pool = ChipPool(players)
     game_over = False
     winner = None
 
     while not game_over:
-        for player in players:
+        for i, player in enumerate(players):
             if game_over:
                 break
             player.step1()
             if player.has_won:
-                winner = player
-                logging.debug("%s has won the game!", player.name)
+                winner = i
+                if DEBUG:
+                    logging.debug("%s has won the game!", player.name)
                 game_over = True
                 break
             player.step2(pool)
             player.step3(players)
 
-    logging.debug("\n=========\nGAME OVER\n=========")
+    if DEBUG:
+        logging.debug("\n=========\nGAME OVER\n=========")
 
     return winner
 
 
+@njit(cache=True)
+def draw_kernel(pool, state):
+    """
+    Compiled ChipPool.draw, refilling pool from the chips not in state
+
+    Returns the index of the chip drawn, i.e. its value - 1.
+    """
+    if pool[POOL_TOTAL] == 0:
+        pool[:10] = BASE_CHIPS - state[:, :10].sum(axis=0)
+        pool[POOL_TOTAL] = pool[:10].sum()
+    r = np.random.random() * pool[POOL_TOTAL]
+    cumulative = 0
+    for c in range(10):
+        cumulative += pool[c]
+        if r < cumulative:
+            break
+    pool[c] -= 1
+    pool[POOL_TOTAL] -= 1
+    return c
+
+
+@njit(cache=True)
+def opponent_totals_kernel(state, i):
+    """Compiled Player.calc_opponent_totals for player i"""
+    stealable = 0
+    stolen = 0
+    held = state[i, HELD]
+    for j in range(state.shape[0]):
+        if j == i:
+            continue
+        for c in range(10):
+            value = CHIP_VALUES[c] * state[j, c]
+            stealable += value
+            stolen += value * ((held >> c) & 1)
+    return stealable, stolen
+
+
+@njit(cache=True, inline="always")
+def will_draw_kernel(strategy_id, params, drawn, state, i):
+    """
+    Compiled Player.will_draw for the AI strategy_id
+
+    params is the player's packed Player.params and drawn the number of chips
+    drawn so far this turn by player i.
+    """
+    if strategy_id == THRESHOLD:
+        return drawn < params[0]
+    if strategy_id == RANDOM:
+        return np.random.random() < params[0]
+    if strategy_id == CONSERVATIVE:
+        if drawn < params[1]:
+            return True
+        return opponent_totals_kernel(state, i)[1] < params[0]
+    if params[2] and drawn < params[2]:
+        return True
+    stealable, stolen = opponent_totals_kernel(state, i)
+    return stealable > params[0] or stolen < params[1]
+
+
+@njit(cache=True)
+def step1_kernel(state, i):
+    """Compiled Player.step1 for player i"""
+    advance = 0
+    if state[i, DIAMONDS] == 3:
+        state[i, DIAMONDS] = 0
+        advance += 50
+    for c in range(10):
+        advance += CHIP_VALUES[c] * state[i, c]
+        state[i, c] = 0
+    state[i, HELD] = 0
+    state[i, SCORE] += advance
+    if state[i, SCORE] >= 100:
+        state[i, HAS_WON] = 1
+
+
+@njit(cache=True)
+def step2_kernel(state, i, pool, strategy_id, params):
+    """Compiled Player.step2 for player i"""
+    sid = strategy_id[i]
+    p = params[i]
+    drawn = 0
+    while will_draw_kernel(sid, p, drawn, state, i):
+        c = draw_kernel(pool, state)
+        drawn += 1
+        # step1 emptied the hand, so it holds at most one of each chip
+        if state[i, HELD] & (1 << c):
+            if drawn <= 3:
+                state[i, DIAMONDS] += 1
+            state[i, :10] = 0
+            state[i, HELD] = 0
+            break
+        state[i, c] = 1
+        state[i, HELD] |= 1 << c
+    state[i, DRAWN] = drawn
+
+
+@njit(cache=True)
+def step3_kernel(state, i):
+    """Compiled Player.step3 for player i"""
+    held = state[i, HELD]
+    for j in range(state.shape[0]):
+        if j == i or not state[j, HELD] & held:
+            continue
+        state[j, HELD] &= ~held
+        for c in range(10):
+            stolen = state[j, c] * ((held >> c) & 1)
+            state[i, c] += stolen
+            state[j, c] -= stolen
+
+
+@njit(cache=True)
+def game_kernel(state, pool, strategy_id, params):
+    """
+    Compiled game, returning the index of the winner
+
+    state holds a row of N_COLS per player and pool 11 slots, both reset here
+    so they can be reused between games. strategy_id and params are the
+    packed Player.strategy_id and Player.params of each player.
+    """
+    state[:] = 0
+    pool[:10] = BASE_CHIPS
+    pool[POOL_TOTAL] = TOTAL_CHIPS
+    while True:
+        for i in range(state.shape[0]):
+            step1_kernel(state, i)
+            if state[i, HAS_WON]:
+                return i
+            step2_kernel(state, i, pool, strategy_id, params)
+            step3_kernel(state, i)
+
+
+@njit(cache=True, parallel=True)
+def experiment_kernel(seat_ids, seat_params, n_chunks):
+    """
+    Compiled experiment loop, returning the winning seat of each game
+
+    seat_ids and seat_params hold, for each game, the packed strategy id and
+    params of the player in each seat. The games are split in n_chunks run
+    in parallel, each with its own game buffers.
+    """
+    N, n_players = seat_ids.shape
+    winners = np.empty(N, dtype=np.int64)
+    for t in prange(n_chunks):
+        state = np.empty((n_players, N_COLS), dtype=np.int32)
+        pool = np.empty(11, dtype=np.int32)
+        for g in range(t * N // n_chunks, (t + 1) * N // n_chunks):
+            winners[g] = game_kernel(state, pool, seat_ids[g], seat_params[g])
+    return winners
+
+
+def draw_seats(rng, N, n_players, K):
+    """
+    Draw the strategies of n_players for N games, from K strategies
+
+    Every game draws its own integer weights 0-10 for the strategies.
+    """
+    weights = rng.integers(0, 11, (N, K))
+    empty = ~weights.any(axis=1)
+    while empty.any():
+        weights[empty] = rng.integers(0, 11, (empty.sum(), K))
+        empty = ~weights.any(axis=1)
+    cumulative = weights.cumsum(axis=1)
+    r = rng.random((N, n_players, 1)) * cumulative[:, None, -1:]
+    return (cumulative[:, None, :] <= r).sum(axis=2)
+
+
 def experiment(n_players, N):
     """experiment loop"""
     instantiations = [
@@ -285,36 +500,23 @@ def experiment(n_players, N):
         [ConservativePlayer, ("Conservative-20", 20, 3)],
         [ConservativePlayer, ("Conservative-30", 30, 3)],
     ]
-    winners = {i[1][0]: 0 for i in instantiations}
-    participations = {i[1][0]: 0 for i in instantiations}
-    for _ in range(N):
-        weights = [random.randint(0, 10) for _ in instantiations]
-        players = []
-        for c, a in random.choices(
-            instantiations,
-            weights=weights,
-            k=n_players,
-        ):
-            players.append(c(*a, players=players))
-
-        logging.info("Weights: %s", weights)
-        logging.info("players: %s", [p.name for p in players])
-        for player in players:
-            player.reset()
-
-        winners[game(players).name] += 1
-        for player in players:
-            participations[player.name] += 1
+    names = [a[0] for _, a in instantiations]
+    strategies = [c(*a) for c, a in instantiations]
+    strategy_ids = np.array([p.strategy_id for p in strategies], dtype=np.int32)
+    strategy_params = np.array([p.params for p in strategies], dtype=np.float64)
+    K = len(instantiations)
+    seats = draw_seats(np.random.default_rng(), N, n_players, K)
+    winner_seats = experiment_kernel(
+        strategy_ids[seats], strategy_params[seats], get_num_threads()
+    )
+    winners = np.bincount(seats[np.arange(N), winner_seats], minlength=K)
+    participations = np.bincount(seats.ravel(), minlength=K)
 
     logging.warning("Experiment results for %d players, %d rounds", n_players, N)
     logging.warning("Base chance: %.2f%%", 1 / n_players * 100)
     logging.warning("Winner statistics:")
-    win_rates = []
-    for player, wins in winners.items():
-        win_rate = wins / participations[player] * 100
-        win_rates.append((win_rate, player))
-    win_rates.sort()
-    win_rates.reverse()
+    rates = winners / participations * 100
+    win_rates = [(float(rates[k]), names[k]) for k in np.argsort(-rates)]
     for win_rate, player in win_rates:
         logging.warning("%s: %.2f%%", player, win_rate)
     logging.warning("========================\n")
@@ -324,9 +526,9 @@ def experiment(n_players, N):
 def main():
     """Main loop"""
     logging.basicConfig(format="%(message)s", level=logging.WARNING)
-    args = [(n_players, 5000) for n_players in range(2, 8)]
-    with multiprocessing.Pool() as p:
-        p.starmap(experiment, args)
+    # Each experiment already runs its games on every core
+    for n_players in range(2, 8):
+        experiment(n_players, 5000)
 
 
 if __name__ == "__main__":